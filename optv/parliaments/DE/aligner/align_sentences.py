@@ -7,35 +7,99 @@ import logging
 logger = logging.getLogger(__name__)
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from itertools import groupby
+from functools import lru_cache
+from itertools import chain, count
 import json
+import multiprocessing
 import os
 from pathlib import Path
 import shutil
 import sys
 import time
 from typing import Iterable, Optional
-from urllib.request import urlretrieve
 
 from aeneas.executetask import ExecuteTask
-from aeneas.task import Task
+from aeneas.syncmap import SyncMapFragment
+from aeneas.task import Task, TaskConfiguration
+from filelock import FileLock
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from ..common import load_json, save_json, worker_count
+except ImportError:
+    # Invoked as a script. Tweak the sys.path
+    base_dir = Path(__file__).resolve().parent.parent
+    sys.path.insert(0, str(base_dir))
+    from common import load_json, save_json, worker_count
 
 # We want to check that we have 1GB minimum available cache size
 MIN_CACHE_SPACE = 1024 * 1024 * 1024
 DEFAULT_CACHEDIR = '/tmp/cache'
+# Free cache space is checked before the first download, then every
+# DISK_CHECK_INTERVAL downloads.
+DISK_CHECK_INTERVAL = 50
+# Connect/read timeouts for media downloads (in seconds)
+DOWNLOAD_TIMEOUT = (5, 60)
+
+# aeneas task options, in addition to language and text/output formats
+AENEAS_OPTIONS = """task_adjust_boundary_no_zero=false|task_adjust_boundary_nonspeech_min=2|task_adjust_boundary_nonspeech_string=REMOVE|task_adjust_boundary_nonspeech_remove=REMOVE|is_audio_file_detect_head_min=0.1|is_audio_file_detect_head_max=3|is_audio_file_detect_tail_min=0.1|is_audio_file_detect_tail_max=3|task_adjust_boundary_algorithm=aftercurrent|task_adjust_boundary_aftercurrent_value=0.5|is_audio_file_head_length=1"""
+
+# HTTP session shared by all downloads of the process, so that
+# connections to the media server are reused.
+_SESSION = None
+# Number of downloads done by the process
+_DOWNLOAD_COUNTER = count(1)
+
+def http_session() -> requests.Session:
+    """Return the HTTP session for the current process.
+    """
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8,
+                              pool_maxsize=8,
+                              max_retries=Retry(total=5, backoff_factor=1))
+        _SESSION.mount('http://', adapter)
+        _SESSION.mount('https://', adapter)
+    return _SESSION
+
+@lru_cache(maxsize=None)
+def task_configuration(language: str) -> TaskConfiguration:
+    """Return the aeneas task configuration for the given language.
+
+    The configuration string is parsed only once per process, and the
+    configuration is shared by all tasks.
+    """
+    return TaskConfiguration(f"""task_language={language}|is_text_type=parsed|os_task_file_format=json|{AENEAS_OPTIONS}""")
+
+def speech_sentence_list(speech: dict) -> list:
+    """Return the list of all sentences in a speech, with a unique identifier.
 
-def speech_sentence_iter(speech: dict) -> Iterable:
-    """Iterate over all sentences in a speech, adding a unique identifier.
+    It is a list of (identifier, sentence) tuples. Only 'speech'
+    sentences are considered.
+
+    Identifiers are computed once (and interned), the list is then
+    used both to generate the aeneas text file and to inject timings.
     """
     speechIndex = speech['speechIndex']
-    for contentIndex, content in enumerate(speech.get('textContents', [])):
-        for bodyIndex, body in enumerate(content['textBody']):
-            # Consider only 'speech' sentences
-            if body['type'] == 'speech':
-                for sentenceIndex, sentence in enumerate(body.get('sentences', [])):
-                    ident = f"s{speechIndex}-{contentIndex}-{bodyIndex}-{sentenceIndex}"
-                    yield ident, sentence
+    return [ (sys.intern(f"s{speechIndex}-{contentIndex}-{bodyIndex}-{sentenceIndex}"), sentence)
+             for contentIndex, content in enumerate(speech.get('textContents', []))
+             for bodyIndex, body in enumerate(content['textBody'])
+             if body['type'] == 'speech'
+             for sentenceIndex, sentence in enumerate(body.get('sentences', [])) ]
+
+def speech_sentences(speech: dict) -> Iterable:
+    """Iterate over all 'speech' sentences in a speech, without identifier.
+    """
+    return (sentence
+            for content in speech.get('textContents', [])
+            for body in content['textBody']
+            if body['type'] == 'speech'
+            for sentence in body.get('sentences', []))
 
 def body_iter(speech: dict) -> Iterable:
     """Iterate over all bodies in a speech
@@ -44,42 +108,65 @@ def body_iter(speech: dict) -> Iterable:
         for bodyIndex, body in enumerate(content['textBody']):
             yield body
 
-def previous_current_next(iterable):
-    """Make an iterator that yields an (previous, current, next) tuple per element.
-
-    Returns None if the value does not make sense (i.e. previous before
-    first and next after last).
-    Adapted from: https://gist.github.com/mortenpi/9604377
-    """
-    iterable=iter(iterable)
-    prv = None
-    cur = next(iterable)
-    try:
-        while True:
-            nxt = next(iterable)
-            yield (prv, cur, nxt)
-            prv = cur
-            cur = nxt
-    except StopIteration:
-        yield (prv, cur, None)
-
 def cachedfile(speech: dict, extension: str, cachedir: Path) -> Path:
     """Return a filename with given extension
+
+    The cachedir/audio (and cachedir/locks) directories are created
+    once by align_audio, so that we do not have to check for them for
+    each file. cachedir is
+    also resolved by align_audio, so the filename is absolute.
     """
     period = speech['electoralPeriod']['number']
     meeting = speech['session']['number']
     speechIndex = speech['speechIndex']
-    filename = f"{period}{str(meeting).rjust(3, '0')}{speechIndex}.{extension}"
-    audiodir = cachedir / "audio"
-    if not audiodir.is_dir():
-        audiodir.mkdir(parents=True)
-    return audiodir / filename
+    return cachedir / "audio" / f"{period}{str(meeting).rjust(3, '0')}{speechIndex}.{extension}"
 
-def mediafile(speech: dict, cachedir: Path, mediatype='audio') -> Optional[Path]:
+def download(uri: str, destination: Path) -> Path:
+    """Download uri into destination.
+
+    Data is first stored in a .part file, which is moved to destination
+    once complete. If a .part file is already present (from an
+    interrupted download), the download is resumed.
+    """
+    partfile = destination.with_name(f"{destination.name}.part")
+    offset = partfile.stat().st_size if partfile.exists() else 0
+    headers = { 'Range': f'bytes={offset}-' } if offset else {}
+    with http_session().get(uri, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as r:
+        if offset and r.status_code == 416:
+            # Range not satisfiable: the .part file should already be
+            # complete. Check it against the remote size (Content-Range:
+            # bytes */<size>), since the remote file may have changed.
+            total = r.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit() and int(total) == offset:
+                os.replace(partfile, destination)
+                return destination
+            logger.warning(f"Partial download {partfile.name} does not match remote size {total or 'unknown'} - restarting it")
+            partfile.unlink()
+            return download(uri, destination)
+        r.raise_for_status()
+        if r.status_code != 206:
+            # Range not supported by the server (or no range
+            # requested) - get the whole file.
+            offset = 0
+        with open(partfile, 'ab' if offset else 'wb') as f:
+            shutil.copyfileobj(r.raw, f, length=1024 * 1024)
+    os.replace(partfile, destination)
+    return destination
+
+def enough_cache_space(cachedir: Path) -> bool:
+    """Check that we have enough disk space for caching.
+    """
+    total, used, free = shutil.disk_usage(cachedir)
+    if free < MIN_CACHE_SPACE:
+        logger.error(f"No enough disk space for cache dir: {free / 1024 / 1024 / 1024} GB")
+        return False
+    return True
+
+def mediafile(speech: dict, cachedir: Path, mediatype='audio', allow_download: bool = True) -> Optional[Path]:
     """Get an mediafile for the given dict.
 
     Either it is already cached (return filename) or download it
-    first.
+    first (unless allow_download is False).
 
     If anything wrong happens, return None
     """
@@ -89,103 +176,191 @@ def mediafile(speech: dict, cachedir: Path, mediatype='audio') -> Optional[Path]
         extension = 'mp4'
         item = 'videoFileURI'
     media = cachedfile(speech, extension, cachedir)
-    if not media.exists():
-        # Check that we have enough disk space for caching
-        total, used, free = shutil.disk_usage(cachedir)
-        if free < MIN_CACHE_SPACE:
-            logger.error(f"No enough disk space for cache dir: {free / 1024 / 1024 / 1024} GB")
-            return None
-
-        # Not yet cached file - download it
-        mediaURI = speech.get('media', {}).get(item)
-        if not mediaURI:
-            logger.error(f"No {item} for {speech['session']['number']}{speech['speechIndex']}")
-            return None
-        logger.warning(f"Downloading {mediaURI} into {media.name}")
-        try:
-            (fname, headers) = urlretrieve(mediaURI, str(media))
-        except Exception as e:
-            logger.error(f"Cannot download {mediaURI}: {e}")
-            return None
+    if media.exists():
+        # Already cached - no need to lock anything
+        return media
+    # Media may be downloaded by concurrent threads or processes - make
+    # sure that they do not download the same file at the same time.
+    # Lock files are kept apart, so that the audio dir only has media.
+    with FileLock(cachedir / "locks" / f"{media.name}.lock"):
+        if not media.exists():
+            if not allow_download:
+                return None
+            # Free space is checked by align_audio before downloading
+            # anything. Check it again regularly for long batches.
+            if (next(_DOWNLOAD_COUNTER) % DISK_CHECK_INTERVAL == 0
+                and not enough_cache_space(cachedir)):
+                return None
+
+            # Not yet cached file - download it
+            mediaURI = speech.get('media', {}).get(item)
+            if not mediaURI:
+                logger.error(f"No {item} for {speech['session']['number']}{speech['speechIndex']}")
+                return None
+            logger.warning(f"Downloading {mediaURI} into {media.name}")
+            try:
+                download(mediaURI, media)
+            except Exception as e:
+                logger.error(f"Cannot download {mediaURI}: {e}")
+                return None
     return media
 
 
-def align_audio(source: list, language: str, cachedir: Path = None, force: bool = False) -> list:
+def alignment_required(speech: dict, force: bool = False) -> bool:
+    """Check if the speech has sentences that should be time-aligned.
+    """
+    sentences = speech_sentences(speech)
+    # Do we have proceedings data to align?
+    first = next(sentences, None)
+    if first is None:
+        logger.debug(f"No text data to align - skipping {speech['session']['number']}{speech['speechIndex']}")
+        return False
+
+    # Do we have any sentence without timing information? Stop at the
+    # first one.
+    if not force and all(sentence.get('timeStart') is not None
+                         for sentence in chain((first, ), sentences)):
+        logger.debug("All sentences already aligned")
+        return False
+
+    return True
+
+def speech_mediafile(speech: dict, cachedir: Path, allow_download: bool = True) -> Optional[Path]:
+    """Get the mediafile to use for aligning the speech.
+
+    Use the audio file if available, else fallback on the video file.
+    """
+    media = mediafile(speech, cachedir, mediatype='audio', allow_download=allow_download)
+    if media is None:
+        # No audio. Try to fallback on video.
+        media = mediafile(speech, cachedir, mediatype='video', allow_download=allow_download)
+    return media
+
+def write_sentence_file(speech: dict, sentence_list: list, cachedir: Path) -> Path:
+    """Generate parsed text format file with identifier + sentence
+    """
+    sentence_file = cachedfile(speech, 'txt', cachedir)
+    # Build the whole content and write it at once. aeneas reads it line
+    # by line, so use plain \n as line separator.
+    lines = ("|".join((ident, sentence['text'].replace('\n', ' ').replace('|', '-')))
+             for (ident, sentence) in sentence_list)
+    sentence_file.write_bytes(("\n".join(lines) + "\n").encode('utf-8'))
+    return sentence_file
+
+def _align_files(media: str, sentence_file: str, language: str) -> tuple:
+    """Align the given sentence file with the given media file.
+
+    It is run in a worker process, so only the timing information is
+    sent back to the caller: it returns a (fragments, duration) tuple,
+    where fragments is the list of (identifier, begin, end) tuples of
+    REGULAR fragments (other can be HEAD/TAIL...).
+    """
+    start_time = time.time()
+    logger.warning(f"Aligning {sentence_file} with {media}")
+    # Do the alignment
+    task = Task()
+    task.configuration = task_configuration(language)
+    task.audio_file_path_absolute = media
+    task.text_file_path_absolute = sentence_file
+    # process Task
+    ExecuteTask(task).execute()
+    end_time = time.time()
+
+    # Compare fragment_type directly instead of going through the
+    # is_regular property for each leaf.
+    regular = SyncMapFragment.REGULAR
+    fragments = [ (f.identifier, str(f.begin), str(f.end))
+                  for f in task.sync_map_leaves()
+                  if f.fragment_type == regular ]
+    return fragments, end_time - start_time
+
+def inject_timings(speech: dict, sentence_list: list, fragments: list, duration: float) -> dict:
+    """Inject timing information back into the speech data.
+
+    aeneas preserves the order of the parsed text, so fragments are in
+    the same order as sentence_list.
+    """
+    for (ident, sentence), (identifier, begin, end) in zip(sentence_list, fragments):
+        if identifier != ident:
+            logger.error(f"Fragment mismatch: expected {ident}, got {identifier}")
+            break
+        sentence['timeStart'] = begin
+        sentence['timeEnd'] = end
+
+    debug = speech.setdefault('debug', {})
+    debug['align-duration'] = duration
+
+    # Store 'aligned' state in 'media': are there any aligned
+    # sentences in the speech?
+    speech['media']['aligned'] = any(sentence.get('timeStart') is not None
+                                     for ident, sentence in sentence_list)
+    return speech
+
+def align_audio(source: list, language: str, cachedir: Path = None, force: bool = False, workers: int = None) -> list:
     """Align list of speeches to add timing information to sentences.
 
+    Speeches are aligned in parallel by worker processes. The number
+    of workers can be set with OPTV_ALIGN_WORKERS.
+
     The structure is modified in place, and returned.
     """
     if cachedir is None:
-        cachedir = Path(DEFAULT_CACHEDIR)
+        cachedir = DEFAULT_CACHEDIR
         logger.warning(f"No cache dir specified - using default {cachedir}")
-    else:
-        cachedir = Path(cachedir)
-
-    for speech in source:
-        # Do we have proceedings data to align?
-        sentence_list = [ (ident, sentence) for ident, sentence in speech_sentence_iter(speech) ]
-        if len(sentence_list) == 0:
-            logger.debug(f"No text data to align - skipping {speech['session']['number']}{speech['speechIndex']}")
-            continue
-
-        # Do we have any sentence without timing information?
-        timing_required = [ sentence
-                            for (ident, sentence) in sentence_list
-                            if sentence.get('timeStart') is None ]
-        if len(timing_required) == 0 and not force:
-            logger.debug("All sentences already aligned")
-            continue
-
-        # Download media file
-        media = mediafile(speech, cachedir, mediatype='audio')
-        if media is None:
-            # No audio. Try to fallback on video.
-            media = mediafile(speech, cachedir, mediatype='video')
-        if media is None:
-            logger.debug("Can find no audio nor video.")
-            continue
-
-        # Generate parsed text format file with identifier + sentence
-        sentence_file = cachedfile(speech, 'txt', cachedir)
-        with open(sentence_file, 'wt') as sf:
-            sf.writelines("|".join((ident, sentence['text'].replace('\n', ' ').replace('|', '-'))) + os.linesep
-                          for (ident, sentence) in sentence_list)
-
-        start_time = time.time()
-        logger.warning(f"Aligning {sentence_file} with {media}")
-        # Do the alignment
-        aeneas_options = """task_adjust_boundary_no_zero=false|task_adjust_boundary_nonspeech_min=2|task_adjust_boundary_nonspeech_string=REMOVE|task_adjust_boundary_nonspeech_remove=REMOVE|is_audio_file_detect_head_min=0.1|is_audio_file_detect_head_max=3|is_audio_file_detect_tail_min=0.1|is_audio_file_detect_tail_max=3|task_adjust_boundary_algorithm=aftercurrent|task_adjust_boundary_aftercurrent_value=0.5|is_audio_file_head_length=1"""
-
-        task = Task(config_string=f"""task_language={language}|is_text_type=parsed|os_task_file_format=json|{aeneas_options}""")
-        task.audio_file_path_absolute = str(media.absolute())
-        task.text_file_path_absolute = str(sentence_file.absolute())
-        # process Task
-        ExecuteTask(task).execute()
-        end_time = time.time()
-
-        # Keep only REGULAR fragments (other can be HEAD/TAIL...)
-        fragments = dict(  (f.identifier, f)
-                           for f in task.sync_map_leaves()
-                           if f.is_regular )
-
-        # Inject timing information back into the source data
-        for ident, sentence in speech_sentence_iter(speech):
-            sentence['timeStart'] = str(fragments[ident].begin)
-            sentence['timeEnd'] = str(fragments[ident].end)
-
-        debug = speech.setdefault('debug', {})
-        debug['align-duration'] = end_time - start_time
-
-        # Store 'aligned' state in 'media'
-
-        # Are there any aligned sentences in the speech?
-        sentence_list = [ (ident, sentence)
-                          for ident, sentence in speech_sentence_iter(speech)
-                          if sentence.get('timeStart') is not None ]
-        speech['media']['aligned'] = (len(sentence_list) > 0)
-
-        # Cleanup generated files (keep cached media)
-        sentence_file.unlink()
+    if workers is None:
+        workers = worker_count('OPTV_ALIGN_WORKERS')
+    # Resolve it once, so that all cached file paths are absolute
+    cachedir = Path(cachedir).resolve()
+    (cachedir / "audio").mkdir(parents=True, exist_ok=True)
+    (cachedir / "locks").mkdir(parents=True, exist_ok=True)
+    # If there is not enough space, only align speeches with
+    # already cached media.
+    allow_download = enough_cache_space(cachedir)
+    if not allow_download:
+        logger.error("Not downloading any media")
+
+    # Media files are downloaded by background threads (in speech
+    # order) while already downloaded speeches are aligned by worker
+    # processes. Workers are not forked from this process, since
+    # downloader threads may hold locks (logging, requests, filelock)
+    # at that time.
+    with ThreadPoolExecutor(max_workers=2) as downloader, \
+         ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('forkserver')) as executor:
+        media_futures = [ downloader.submit(speech_mediafile, speech, cachedir, allow_download)
+                          if alignment_required(speech, force) else None
+                          for speech in source ]
+        # Only file paths are sent to worker processes, and only
+        # timing information is sent back, so that speech data is not
+        # serialized through IPC.
+        pending = []
+        try:
+            for speech, media_future in zip(source, media_futures):
+                media = media_future.result() if media_future is not None else None
+                if media is None:
+                    if media_future is not None:
+                        logger.debug("Can find no audio nor video.")
+                    continue
+                sentence_list = speech_sentence_list(speech)
+                sentence_file = write_sentence_file(speech, sentence_list, cachedir)
+                future = executor.submit(_align_files,
+                                         str(media),
+                                         str(sentence_file),
+                                         language)
+                pending.append((speech, sentence_list, sentence_file, future))
+            for speech, sentence_list, sentence_file, future in pending:
+                fragments, duration = future.result()
+                inject_timings(speech, sentence_list, fragments, duration)
+        except BaseException:
+            # Do not wait for queued downloads/alignments before
+            # reporting the error
+            downloader.shutdown(cancel_futures=True)
+            executor.shutdown(cancel_futures=True)
+            raise
+        finally:
+            # Cleanup generated files (keep cached media)
+            for _, _, sentence_file, _ in pending:
+                sentence_file.unlink(missing_ok=True)
 
     # We have aligned all "speech"-type bodies. Go through all speeches and
     # use "speech" timecodes to estimate "comment"-type timecodes.
@@ -193,36 +368,41 @@ def align_audio(source: list, language: str, cachedir: Path = None, force: bool
         if not speech.get('textContents'):
             # No text to align
             continue
-        for prv, cur_list, nxt in previous_current_next(list(arr)
-                                                   for (key, arr) in groupby(body_iter(speech),
-                                                                             key=lambda body: body['type']
-                                                                             )):
+        bodies = list(body_iter(speech))
+        # Forward scan: remember the last non-comment body preceding
+        # each body.
+        previous = []
+        prv = None
+        for body in bodies:
+            previous.append(prv)
+            if body['type'] != 'comment':
+                prv = body
+        # Backward scan: carry the first non-comment body following
+        # each body, and copy timestamps from prv/nxt bodies sentences
+        # into comments.
+        nxt = None
+        for cur, prv in zip(reversed(bodies), reversed(previous)):
+            if cur['type'] != 'comment':
+                nxt = cur
+                continue
+            start = ''
+            end = ''
             if prv:
-                # prv is the list of previous bodies. Take the last one.
-                prv = prv[-1]
+                # Using start timecode of last sentence of previous body
+                start = prv['sentences'][-1].get('timeStart', '')
+            elif nxt:
+                # Using first timecode of first sentence of next body
+                start = nxt['sentences'][0].get('timeStart', '')
+
             if nxt:
-                nxt = nxt[0]
-            for cur in cur_list:
-                if cur['type'] == 'comment':
-                    # Copy timestamps from prv/nxt bodies sentences
-                    start = ''
-                    end = ''
-                    if prv:
-                        # Using start timecode of last sentence of previous body
-                        start = prv['sentences'][-1].get('timeStart', '')
-                    elif nxt:
-                        # Using first timecode of first sentence of next body
-                        start = nxt['sentences'][0].get('timeStart', '')
-
-                    if nxt:
-                        end = nxt['sentences'][0].get('timeEnd', '')
-                    elif prv:
-                        end = prv['sentences'][-1].get('timeEnd', '')
-
-                    if start:
-                        cur['sentences'][0]['timeStart'] = start
-                    if end:
-                        cur['sentences'][0]['timeEnd'] = end
+                end = nxt['sentences'][0].get('timeEnd', '')
+            elif prv:
+                end = prv['sentences'][-1].get('timeEnd', '')
+
+            if start:
+                cur['sentences'][0]['timeStart'] = start
+            if end:
+                cur['sentences'][0]['timeEnd'] = end
 
     return source
 
@@ -230,20 +410,19 @@ def align_audiofile(sourcefile: Path,
                     destinationfile: Path,
                     language: str,
                     cachedir: Path = None,
-                    force: bool = False) -> Path:
-    with open(sourcefile) as f:
-        source = json.load(f)
+                    force: bool = False,
+                    workers: int = None) -> Path:
+    source = load_json(sourcefile)
     output = { "meta": { **source['meta'],
                          'processing': {
                              **source['meta'].get('processing', {}),
                              "align": datetime.now().isoformat('T', 'seconds'),
                          }
                         },
-               "data": align_audio(source['data'], language, cachedir, force)
+               "data": align_audio(source['data'], language, cachedir, force, workers)
               }
     if destinationfile is not None:
-        with open(destinationfile, 'w') as f:
-            json.dump(output, f, indent=2, ensure_ascii=False)
+        save_json(output, destinationfile)
     else:
         json.dump(output, sys.stdout, indent=2, ensure_ascii=False)
     return output
@@ -261,6 +440,8 @@ if __name__ == '__main__':
     parser.add_argument("--force", action="store_true",
                         default=False,
                         help="Force alignment, even if all sentences are already aligned.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of parallel alignment processes (default: OPTV_ALIGN_WORKERS or number of CPUs, at most 8)")
     parser.add_argument("--debug", dest="debug", action="store_true",
                         default=False,
                         help="Display debug messages")
@@ -275,4 +456,4 @@ if __name__ == '__main__':
         loglevel = logging.DEBUG
     logging.basicConfig(level=loglevel)
 
-    align_audiofile(args.source, args.destination, args.lang, args.cache_dir, args.force)
+    align_audiofile(args.source, args.destination, args.lang, args.cache_dir, args.force, args.workers)
@@ -4,9 +4,32 @@ import logging
 logger = logging.getLogger(__name__)
 
 from enum import Enum, auto
-from hashlib import blake2b
+from functools import lru_cache
 import json
+import mmap
+import os
 from pathlib import Path
+import re
+import sys
+from typing import Iterable, Optional
+import unicodedata
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    # orjson is much faster for large session files, but we can do
+    # without it.
+    orjson = None
+
+try:
+    import ijson
+except ModuleNotFoundError:
+    # ijson allows to stream session files when we only need to
+    # inspect part of them.
+    ijson = None
+
+# Files larger than this (in bytes) are memory-mapped by load_json
+MMAP_THRESHOLD = 512 * 1024
 
 class SessionStatus(Enum):
     media = auto()
@@ -19,11 +42,95 @@ class SessionStatus(Enum):
     empty = auto()
     no_text = auto()
 
-def data_signature(data: list) -> str:
-    """Return a signature (as a string) for the given data.
+# Status flags which are determined from the session data (see data_status)
+DATA_STATUS = (SessionStatus.empty,
+               SessionStatus.linked,
+               SessionStatus.no_text,
+               SessionStatus.aligned,
+               SessionStatus.ner)
+
+def data_status(data: Iterable) -> set:
+    """Return the set of SessionStatus flags determined from session data.
+
+    data may be any iterable of speeches (e.g. a stream of items), it
+    is consumed in a single pass, and only as far as needed.
+    """
+    status = set()
+    empty = True
+    for s in data:
+        empty = False
+        # Check for wid/wtype in people, in the first non-empty people list
+        if (SessionStatus.linked not in status
+            and s.get('people') and s['people'][0].get('wid')):
+            status.add(SessionStatus.linked)
+        if SessionStatus.no_text not in status:
+            # Check for proceedingIndex information (indication that
+            # proceedings were merged). Speeches after the first
+            # one without it are not considered for aligned/ner.
+            if s['debug'].get('proceedingIndex') is None:
+                status.add(SessionStatus.no_text)
+            else:
+                # Just test on s['debug']['align-duration'] rather than
+                # looking for a timeStart attribute in sentences
+                if s.get('debug', {}).get('align-duration'):
+                    status.add(SessionStatus.aligned)
+                if s.get('debug', {}).get('ner-duration'):
+                    status.add(SessionStatus.ner)
+        if SessionStatus.no_text in status and SessionStatus.linked in status:
+            # Nothing more to learn from the remaining speeches
+            break
+    if empty:
+        status.add(SessionStatus.empty)
+    return status
+
+def load_json(filename: Path):
+    """Load JSON data from the given file.
+
+    The whole file content is read at once, then parsed from memory.
+    With orjson, large files are memory-mapped and parsed directly
+    from the mapping.
     """
-    h = blake2b(json.dumps(data).encode('utf-8'))
-    return h.hexdigest()
+    if orjson is not None:
+        if os.path.getsize(filename) > MMAP_THRESHOLD:
+            with open(filename, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    with memoryview(mm) as view:
+                        return orjson.loads(view)
+        return orjson.loads(Path(filename).read_bytes())
+    return json.loads(Path(filename).read_bytes())
+
+def stream_json(filename: Path):
+    """Load JSON data (an object) from the given file, parsing it as a stream.
+
+    It avoids holding the whole file content in memory in addition to
+    the parsed data. If ijson is not available, fallback on load_json.
+    """
+    if ijson is None:
+        logger.warning("ijson is not available - cannot stream JSON data")
+        return load_json(filename)
+    with open(filename, 'rb') as f:
+        return dict(ijson.kvitems(f, '', use_float=True))
+
+def save_json(data, filename: Path) -> Path:
+    """Save data as (indented) JSON into the given file.
+
+    Data is written into a temporary file, which then replaces the
+    given file, so that readers never see a partially written file.
+    """
+    tmp_filename = f"{filename}.tmp"
+    try:
+        if orjson is not None:
+            Path(tmp_filename).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        else:
+            with open(tmp_filename, 'w') as f:
+                json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        # Do not leave an incomplete temporary file behind
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        raise
+    return filename
 
 def save_if_changed(data: dict, output_file: Path) -> bool:
     """Save the data into file if it is different.
@@ -35,21 +142,62 @@ def save_if_changed(data: dict, output_file: Path) -> bool:
     # Consider it as different by default.
     updated_content = True
     if output_file.exists():
-        old_data = json.loads(output_file.read_text())
+        old_data = load_json(output_file)
         # Compare old_data with data, without taking meta info
-        # (processing info) into account.
-        old_digest = data_signature(old_data['data'])
-        new_digest = data_signature(data['data'])
-        if old_digest == new_digest:
+        # (processing info) into account. Compare the structures
+        # directly, rather than serializing both to compute signatures.
+        if old_data['data'] == data['data']:
             # Same content - do not save
             updated_content = False
 
     if updated_content:
-        with open(output_file, 'w') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        save_json(data, output_file)
 
     return updated_content
 
+@lru_cache(maxsize=None)
+def combining_characters() -> dict:
+    """Return a translation table removing all combining characters.
+
+    It is only built when first needed, since it requires checking
+    every codepoint.
+    """
+    return dict.fromkeys(c for c in range(sys.maxunicode + 1)
+                         if unicodedata.combining(chr(c)))
+
+# Translation table removing accents from Latin-1 Supplement and
+# Latin Extended-A characters (which cover almost all names), built
+# with the generic method below.
+LATIN_ACCENTS = dict((c, ''.join(d for d in unicodedata.normalize('NFKD', chr(c))
+                                 if not unicodedata.combining(d)))
+                     for c in range(0x80, 0x180))
+
+@lru_cache(maxsize=4096)
+def remove_accents(input_str):
+    if input_str.isascii():
+        # Nothing to decompose
+        return input_str
+    if max(input_str) < '\u0180':
+        return input_str.translate(LATIN_ACCENTS)
+    nfkd_form = unicodedata.normalize('NFKD', input_str)
+    return nfkd_form.translate(combining_characters())
+
+def worker_count(env_var: str) -> int:
+    """Return the number of worker processes to use for a parallel step.
+
+    It can be specified through the env_var environment variable, else
+    it is the number of CPUs, at most 8.
+    """
+    return int(os.environ.get(env_var, 0)) or min(os.cpu_count() or 1, 8)
+
+def mtime_ns(path: Path) -> Optional[int]:
+    """Return the modification time of path (in ns), or None if it does not exist.
+    """
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
 class Config:
     def __init__(self, data_dir: Path,
                  cache_dir: Path = None):
@@ -67,34 +215,50 @@ class Config:
             'aligned': cache_dir / "aligned",
             'ner': cache_dir / "ner",
             'processed': data_dir / "processed",
-            'nel_data': data_dir / "metadata"
+            'nel_data': data_dir / "metadata",
+            # Cached status info for processed sessions
+            'status': cache_dir / "status",
         }
+        # Filename template parts (directory prefix, suffix) for
+        # session files of each stage, so that file() only needs to
+        # format a string.
+        self._file_parts = dict( (stage, (f"{d}{os.sep}", 'session' if stage == 'processed' else stage))
+                                 for stage, d in self._dir.items() )
+        # Stages for which the directory is known to exist
+        self._existing_dirs = set()
+        # In-memory caches for sessions/status, validated against
+        # directory/file modification times.
+        self._sessions_cache = {}
+        self._status_cache = {}
 
 
     def dir(self, stage: str = 'processed', create: bool = False) -> Path:
         d = self._dir[stage]
-        if create and not d.is_dir():
-            d.mkdir(parents=True)
+        if create:
+            self._create_dir(stage)
         return d
 
 
+    def _create_dir(self, stage: str):
+        """Make sure that the directory for stage exists.
+        """
+        if stage not in self._existing_dirs:
+            self._dir[stage].mkdir(parents=True, exist_ok=True)
+            self._existing_dirs.add(stage)
+
+
     def file(self, session: str, stage: str = 'processed', create = False) -> Path:
-        suffix = stage
-        d = self._dir[stage]
-        if stage == 'processed':
-            suffix = 'session'
+        prefix, suffix = self._file_parts[stage]
         if create:
             # Make sure the containing directory exists
-            if not d.is_dir():
-                d.mkdir(parents=True)
-        return d / f"{session}-{suffix}.json"
+            self._create_dir(stage)
+        return Path(f"{prefix}{session}-{suffix}.json")
 
 
     def data(self, session: str, stage: str = 'processed') -> list:
         filename = self.file(session, stage)
         if filename.exists():
-            with open(filename) as f:
-                data = json.load(f)
+            data = load_json(filename)
         else:
             logger.warning(f"No data for {session}-{stage}")
             data = []
@@ -117,69 +281,91 @@ class Config:
         Return the Path of the created file.
         """
         logger.debug(f"Saving {session} {stage} data")
-        outfile = self.file(session, stage)
         # Make sure the containing directory exists
-        if not outfile.parent.is_dir():
-            outfile.parent.mkdir(parents=True)
-        with open(outfile, "w") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        return outfile
+        outfile = self.file(session, stage, create=True)
+        return save_json(data, outfile)
 
 
     def sessions(self, prefix: str = ''):
         """Return the list of current existing sessions
 
-        The list is built from the available media source files.
+        The list is built from the available media source files. It is
+        cached until the media directory is modified.
         """
-        return list(sorted(f.name[4:9] for f in self.dir('media').glob(f'raw-{prefix}*-media.json')))
+        media_dir = self.dir('media')
+        try:
+            mtime = media_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            # No media yet
+            return []
+        cached = self._sessions_cache.get(prefix)
+        if cached is None or cached[0] != mtime:
+            media_re = re.compile(rf'^raw-(?={re.escape(prefix)})(\d+)-media\.json$')
+            with os.scandir(media_dir) as entries:
+                matches = [ media_re.match(entry.name)
+                            for entry in entries
+                            if entry.is_file() ]
+            cached = (mtime, list(sorted(m.group(1) for m in matches if m)))
+            self._sessions_cache[prefix] = cached
+        return list(cached[1])
 
 
     def status(self, session: str) -> set:
         """Return the status for the given session.
 
-        Return set of SessionStatus flags.
+        Return set of SessionStatus flags. It is cached until one of
+        the session files is modified.
         """
+        stages = ('media', 'proceedings', 'merged', 'processed')
+        mtimes = tuple(mtime_ns(self.file(session, stage)) for stage in stages)
+        cached = self._status_cache.get(session)
+        if cached is not None and cached[0] == mtimes:
+            return set(cached[1])
+
+        media, proceedings, merged, processed = mtimes
         status = set()
-        if self.file(session, 'media').exists():
+        if media is not None:
             status.add(SessionStatus.media)
-        if self.file(session, 'proceedings').exists():
+        if proceedings is not None:
             status.add(SessionStatus.proceedings)
-        if self.file(session, 'merged').exists():
+        if merged is not None:
             status.add(SessionStatus.merged)
-        sfile = self.file(session, 'processed')
-        if sfile.exists():
+        if processed is not None:
             status.add(SessionStatus.session)
-            with open(sfile, 'r') as f:
-                info = json.load(f)
-                data = info['data']
-            if len(data) == 0:
-                status.add(SessionStatus.empty)
-            # Check for wid/wtype in people, in the first non-empty people list
-            for s in data:
-                if s.get('people') and s['people'][0].get('wid'):
-                    status.add(SessionStatus.linked)
-                    break
-            # Check for proceedingIndex information (indication that proceedings were merged)
-            for s in data:
-                if s['debug'].get('proceedingIndex') is None:
-                    status.add(SessionStatus.no_text)
-                    return status
-            # Trying to find at least 1 timeStart attribute
-            # for s in data:
-            #     for tc in s['textContents']:
-            #         for b in tc['textBody']:
-            #             for sentence in b['sentences']:
-            #                 if sentence.get('timeStart') is not None:
-            #                     status.add('aligned')
-            #                     break
-            # Just test on s['debug']['align-duration']
-                if s.get('debug', {}).get('align-duration'):
-                    status.add(SessionStatus.aligned)
-                if s.get('debug', {}).get('ner-duration'):
-                    status.add(SessionStatus.ner)
+            status.update(self.processed_status(session))
+
+        self._status_cache[session] = (mtimes, frozenset(status))
+        return status
+
 
+    def processed_status(self, session: str) -> set:
+        """Return the status flags determined from the processed session data.
+
+        They are read from the status cache file if it is up-to-date,
+        else they are computed from the processed file (and cached).
+        """
+        if not self.is_newer(session, 'processed', 'status'):
+            cached = load_json(self.file(session, 'status'))
+            return set(SessionStatus[name] for name, value in cached.items() if value)
+        processed_file = self.file(session, 'processed')
+        if ijson is not None and ijson.backend == 'yajl2_c':
+            # Stream speeches, so that we can stop as soon as all
+            # flags are known. Only worth it with the C backend,
+            # else a full load is faster.
+            with open(processed_file, 'rb') as f:
+                status = data_status(ijson.items(f, 'data.item'))
+        else:
+            status = data_status(load_json(processed_file)['data'])
+        self.save_status(session, status)
         return status
 
+
+    def save_status(self, session: str, status: set) -> Path:
+        """Cache the data-related status flags of the processed session.
+        """
+        return self.save_data({ flag.name: (flag in status) for flag in DATA_STATUS },
+                              session, 'status')
+
 if __name__ == '__main__':
     import sys
     config = Config(Path(sys.argv[1]))
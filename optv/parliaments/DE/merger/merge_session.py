@@ -8,23 +8,34 @@ import logging
 logger = logging.getLogger('merge_session' if __name__ == '__main__' else __name__)
 
 import argparse
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import lru_cache
 import itertools
+import os
 import json
 from pathlib import Path
 import re
 import sys
-import unicodedata
 
-def remove_accents(input_str):
-    nfkd_form = unicodedata.normalize('NFKD', input_str)
-    return u"".join([c for c in nfkd_form if not unicodedata.combining(c)])
+import numpy as np
+
+try:
+    from ..common import load_json, save_json, stream_json, worker_count, remove_accents
+except ImportError:
+    # Invoked as a script. Tweak the sys.path
+    base_dir = Path(__file__).resolve().parent.parent
+    sys.path.insert(0, str(base_dir))
+    from common import load_json, save_json, stream_json, worker_count, remove_accents
 
 def merge_item(mediaitem, proceedingitems):
     # We have both items - copy proceedings data into media item
-    # Make a copy of the media data
-    output = deepcopy(mediaitem)
+    # Make a copy of the media data. Only the top-level dict and the
+    # sub-dicts that we modify (here and in merge_data) are copied,
+    # the other values are shared with mediaitem.
+    output = dict(mediaitem)
+    output['session'] = dict(mediaitem['session'])
+    output['debug'] = dict(mediaitem['debug'])
 
     first_proceeding = proceedingitems[0]
 
@@ -47,9 +58,14 @@ def merge_item(mediaitem, proceedingitems):
     # We do a copy of person info because we will possibly update its
     # context info (when checking main-speaker conflicts), so the same
     # "proceeding" person will have multiple contexts.
-    people_dict = dict( (remove_accents(person['label']), deepcopy(person))
-                        for p in proceedingitems
-                        for person in mediaitem['people'] + p['people'] )
+    # Only role/context are modified, so a shallow copy is enough.
+    # Later occurrences of a person replace earlier ones (keeping the
+    # first position), so we only copy the retained person records.
+    people_dict = {}
+    for p in proceedingitems:
+        for person in itertools.chain(mediaitem['people'], p['people']):
+            people_dict[remove_accents(person['label'])] = person
+    people_dict = dict( (label, dict(person)) for label, person in people_dict.items() )
 
     # Copy back attributes from media if necessary - they may have
     # been overwritten (in the general case)
@@ -104,79 +120,87 @@ def merge_item(mediaitem, proceedingitems):
     output['debug']['confidence'] = confidence
     return output
 
+@lru_cache(maxsize=4096)
+def speaker_label_cleanup(label):
+    return remove_accents(label.lower()).replace(' von der ', ' ').replace('altersprasident ', '')
+
 def speaker_cleanup(item, default_value):
     if item.get('people'):
         # Warning: we use people[0] assuming it is the main
         # speaker. It works because proceedings2json (now) explicitly
         # sorts the people list
-        speaker = remove_accents(item['people'][0]['label'].lower()).replace(' von der ', ' ').replace('altersprasident ', '')
+        speaker = speaker_label_cleanup(item['people'][0]['label'])
     else:
         speaker = default_value
     return speaker
 
-def needleman_wunsch_align(proceedings, media, options):
-    """Align data structures using Needleman-Wunsch algorithm
-    """
-    config = {
-        "speaker_weight": 4,
-        "title_weight": 2,
-        "merge_penalty": -1,
-        "split_penalty": -1,
-    }
-    def build_index(items):
-        return [
-            {
-                "speech_index": item['speechIndex'],
-                "speaker": speaker_cleanup(item, "NO_SPEAKER"),
-                "title": item['agendaItem']['officialTitle'],
-                "item": item
-             }
-            for item in items
-        ]
-    media_index = build_index(media)
-    proceedings_index = build_index(proceedings)
-
-    # Levenshtein has been tested, but gives worse results, because
-    # the differences are too small (last character for TOP)
-    def string_similarity(s1, s2):
-        return s1.strip() == s2.strip()
+# Needleman-Wunsch parameters
+SPEAKER_WEIGHT = 4
+TITLE_WEIGHT = 2
+MERGE_PENALTY = -1
+SPLIT_PENALTY = -1
 
-    # Similarity score between 2 items
-    def similarity(m, p):
-        return (config['speaker_weight'] * string_similarity(m['speaker'], p['speaker'])
-                + config['title_weight'] * string_similarity(m['title'], p['title']))
+def nw_fill_rows(similarity: np.ndarray, split_penalty: int, merge_penalty: int) -> np.ndarray:
+    """Build the Needleman-Wunsch score matrix from the similarity matrix.
 
-    # Build the [m, p] matrix with scores using the Needleman-Wunsch algorithm
-    # https://fr.wikipedia.org/wiki/Algorithme_de_Needleman-Wunsch
+    Rows are computed with numpy operations.
+    """
     # Initialize a m x p matrix
-    scores = [ [ similarity(m, p) for p in proceedings_index ] for m in media_index ]
+    scores = similarity.astype(np.int64)
     # Or 0-initialization?
-    # scores = [ [ 0 for p in proceedings_index ] for m in media_index ]
+    # scores = np.zeros_like(similarity)
 
     # FIXME: maybe we could tweak merge_penalty and split_penalty based on the dissimilarity between media duration and text length.
     # A long media duration with a short text length should favor the merge option
     # Build the score matrix - start at 1 since 0 row/col has no ancestor
-    for i in range(1, len(media_index)):
-        for j in range(1, len(proceedings_index)):
-            scores[i][j] = max( scores[i-1][j-1] + similarity(media_index[i], proceedings_index[j]),
-                                scores[i-1][j] + config['split_penalty'],
-                                scores[i][j-1] + config['merge_penalty'] )
-
-    # Now that the matrix is built, compute a path with a maximal score
-    path = []
-    i = len(media_index) - 1
-    j = len(proceedings_index) - 1
-    max_score = scores[i][j]
+    #   scores[i][j] = max( scores[i-1][j-1] + similarity[i][j],
+    #                       scores[i-1][j] + split_penalty,
+    #                       scores[i][j-1] + merge_penalty )
+    # The first 2 terms only depend on the previous row, so they are
+    # computed for the whole row at once. The merge term chains along
+    # the row: scores[i][j] = max(a[k] + merge_penalty * (j - k)) for
+    # k <= j, which is a cumulative maximum of a[k] - merge_penalty * k.
+    merge_steps = merge_penalty * np.arange(scores.shape[1], dtype=np.int64)
+    for i in range(1, scores.shape[0]):
+        a = scores[i]
+        a[1:] = np.maximum(scores[i-1, :-1] + similarity[i, 1:],
+                           scores[i-1, 1:] + split_penalty)
+        scores[i] = np.maximum.accumulate(a - merge_steps) + merge_steps
+    return scores
+
+def nw_fill_loop(similarity: np.ndarray, split_penalty: int, merge_penalty: int) -> np.ndarray:
+    """Build the Needleman-Wunsch score matrix from the similarity matrix.
+
+    Plain loop version, meant to be compiled with numba.
+    """
+    m, p = similarity.shape
+    scores = similarity.astype(np.int64)
+    for i in range(1, m):
+        for j in range(1, p):
+            scores[i, j] = max(scores[i-1, j-1] + similarity[i, j],
+                               scores[i-1, j] + split_penalty,
+                               scores[i, j-1] + merge_penalty)
+    return scores
+
+def nw_traceback(scores: np.ndarray) -> tuple:
+    """Compute a path with a maximal score in the score matrix.
+
+    Return a (media_indexes, proceeding_indexes) tuple of arrays,
+    from the last items to the first ones.
+    """
+    m, p = scores.shape
+    media_indexes = np.empty(m + p, dtype=np.int64)
+    proceeding_indexes = np.empty(m + p, dtype=np.int64)
+    count = 0
+    i = m - 1
+    j = p - 1
     while i > 0 and j > 0:
-        path.append({ "media_index": i,
-                      "proceeding_index": j,
-                      "score": max_score,
-                      "media": media_index[i]['item'],
-                      "proceeding": proceedings_index[j]['item'],
-                     })
-        diagonal = scores[i - 1][j - 1]
-        up = scores[i][j - 1]
-        left = scores[i - 1][j]
+        media_indexes[count] = i
+        proceeding_indexes[count] = j
+        count += 1
+        diagonal = scores[i - 1, j - 1]
+        up = scores[i, j - 1]
+        left = scores[i - 1, j]
         if diagonal >= up and diagonal >= left:
             i = i - 1
             j = j - 1
@@ -196,21 +220,89 @@ def needleman_wunsch_align(proceedings, media, options):
     # In this case, we should add mutiple steps to reach first media,
     # associating it as a best guess with the same proceeding.
     while i >= 0:
-        path.append({ "media_index": i,
-                      "proceeding_index": j,
-                      "score": max_score,
-                      "media": media_index[i]['item'],
-                      "proceeding": proceedings_index[j]['item'],
-                     })
+        media_indexes[count] = i
+        proceeding_indexes[count] = j
+        count += 1
         i = i - 1
+    return media_indexes[:count], proceeding_indexes[:count]
+
+# (fill, traceback) functions, determined on first use
+_NW_IMPLEMENTATION = None
+
+def nw_implementation() -> tuple:
+    """Return the (fill, traceback) functions to use for Needleman-Wunsch.
+
+    numba-compiled versions are used if numba is available, else we
+    fallback on numpy/python versions.
+    """
+    global _NW_IMPLEMENTATION
+    if _NW_IMPLEMENTATION is None:
+        try:
+            from numba import njit
+            # No on-disk cache: it is keyed by source file, and this
+            # module is imported under different names (as part of
+            # the package, or as a script), which breaks cache loading.
+            _NW_IMPLEMENTATION = (njit(nw_fill_loop),
+                                  njit(nw_traceback))
+        except ImportError:
+            logger.debug("numba is not available - using numpy version of Needleman-Wunsch")
+            _NW_IMPLEMENTATION = (nw_fill_rows, nw_traceback)
+    return _NW_IMPLEMENTATION
+
+def needleman_wunsch_align(proceedings, media, options) -> tuple:
+    """Align data structures using Needleman-Wunsch algorithm
+
+    Return a (media_indexes, proceeding_indexes, score) tuple, where
+    the index lists define the alignment path, in ascending order.
+    """
+    # Levenshtein has been tested, but gives worse results, because
+    # the differences are too small (last character for TOP). So we
+    # simply compare (stripped) strings, which we convert to integer
+    # codes so that the similarity matrix can be computed at once.
+    codes = {}
+    def build_index(items) -> tuple:
+        """Return the (speakers, titles) arrays of codes for items
+        """
+        speakers = np.empty(len(items), dtype=np.int64)
+        titles = np.empty(len(items), dtype=np.int64)
+        for n, item in enumerate(items):
+            speakers[n] = codes.setdefault(speaker_cleanup(item, "NO_SPEAKER").strip(), len(codes))
+            titles[n] = codes.setdefault(item['agendaItem']['officialTitle'].strip(), len(codes))
+        return speakers, titles
+    media_speakers, media_titles = build_index(media)
+    proceedings_speakers, proceedings_titles = build_index(proceedings)
+
+    if (len(media) and np.array_equal(media_speakers, proceedings_speakers)
+        and np.array_equal(media_titles, proceedings_titles)):
+        # Common case: media and proceedings items match one to
+        # one. The optimal path is then the diagonal, there is no
+        # need to build the score matrix.
+        identity = list(range(len(media)))
+        return (identity, list(identity),
+                len(media) * (SPEAKER_WEIGHT + TITLE_WEIGHT))
+
+    # Similarity score matrix between m x p items
+    similarity = (SPEAKER_WEIGHT * (media_speakers[:, None] == proceedings_speakers[None, :])
+                  + TITLE_WEIGHT * (media_titles[:, None] == proceedings_titles[None, :]))
+
+    # Build the [m, p] matrix with scores using the Needleman-Wunsch algorithm
+    # https://fr.wikipedia.org/wiki/Algorithme_de_Needleman-Wunsch
+    nw_fill, nw_traceback = nw_implementation()
+    scores = nw_fill(similarity, SPLIT_PENALTY, MERGE_PENALTY)
+
+    # Now that the matrix is built, compute a path with a maximal score
+    max_score = int(scores[len(media) - 1, len(proceedings) - 1])
+    media_indexes, proceeding_indexes = nw_traceback(scores)
 
     # Reverse the path, so that is in ascending order
-    path.reverse()
+    return (media_indexes[::-1].tolist(),
+            proceeding_indexes[::-1].tolist(),
+            max_score)
 
-    return path
+UTC_OFFSET_RE = re.compile(r'^[+-]\d\d:\d\d$')
 
 def is_utc_offset(s: str) -> bool:
-    return re.match(r'^[+-]\d\d:\d\d$', s)
+    return UTC_OFFSET_RE.match(s) is not None
 
 def merge_data(proceedings, media, options) -> list:
     """Merge data structures.
@@ -218,15 +310,21 @@ def merge_data(proceedings, media, options) -> list:
     If no match is found for a proceedings, we will dump the
     proceedings as-is.
     """
-    path = needleman_wunsch_align(proceedings['data'], media['data'], options)
-
-    # Group by media. There can be multiple proceedings
-    speeches = [
-        merge_item(group[0]['media'],
-                   [ i['proceeding'] for i in group ])
-        for group in [ list(group)
-                       for media_index, group in itertools.groupby(path, lambda i: i['media_index']) ]
-    ]
+    media_data = media['data']
+    proceedings_data = proceedings['data']
+    media_indexes, proceeding_indexes, _ = needleman_wunsch_align(proceedings_data, media_data, options)
+
+    # Group by media. There can be multiple proceedings. The path is
+    # in ascending media order, so buckets are in the same order.
+    buckets = {}
+    for i, j in zip(media_indexes, proceeding_indexes):
+        bucket = buckets.get(i)
+        if bucket is None:
+            buckets[i] = (media_data[i], [ proceedings_data[j] ])
+        else:
+            bucket[1].append(proceedings_data[j])
+    speeches = [ merge_item(mediaitem, proceedingitems)
+                 for mediaitem, proceedingitems in buckets.values() ]
 
     # Add linkedMediaIndexes info - it indicates the cases where the
     # same proceeding has been linked with multiple media items.
@@ -241,11 +339,9 @@ def merge_data(proceedings, media, options) -> list:
             proceeding2media.setdefault(pi, set()).add(mid)
     # Now that we have built the index, put the info in each speech
     for speech in speeches:
-        mid = speech['debug']['mediaIndex']
-        linkedMediaIndexes = list(set(mid
-                                      for pid in speech['debug']['proceedingIndexes']
-                                      for mid in proceeding2media[pid]))
-        speech['debug']['linkedMediaIndexes'] = linkedMediaIndexes
+        linkedMediaIndexes = set().union(*(proceeding2media[pid]
+                                           for pid in speech['debug']['proceedingIndexes']))
+        speech['debug']['linkedMediaIndexes'] = sorted(linkedMediaIndexes)
 
     # Let's fix dateStart/dateEnd: the official info is in proceedings
     # (sitzung-start/ende-uhrzeit), but the UTC offset is only defined
@@ -275,16 +371,22 @@ def merge_data(proceedings, media, options) -> list:
             }
 
 def merge_files(proceedings_file: Path, media_file:Path, options) -> dict:
-    try:
-        with open(proceedings_file) as f:
-            proceedings = json.load(f)
-    except FileNotFoundError:
-        proceedings = None
-    try:
-        with open(media_file) as f:
-            media = json.load(f)
-    except FileNotFoundError:
-        media = None
+    # Large files can be parsed as a stream, to limit memory usage
+    load = stream_json if getattr(options, 'stream', False) else load_json
+
+    def load_if_exists(filename: Path):
+        try:
+            return load(filename)
+        except FileNotFoundError:
+            return None
+
+    # Both files are read concurrently, overlapping their I/O. Set
+    # OPTV_IO_WORKERS=1 to read them sequentially (e.g. on spinning disks)
+    if int(os.environ.get('OPTV_IO_WORKERS', 2)) > 1:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            proceedings, media = executor.map(load_if_exists, (proceedings_file, media_file))
+    else:
+        proceedings, media = map(load_if_exists, (proceedings_file, media_file))
 
     if media is None:
         logger.error("No media file for session")
@@ -309,6 +411,29 @@ def merge_session(session: str, config: "Config", options) -> Path:
 
     return config.save_data(output, session, "merged")
 
+def merge_many(sessions: list, config: "Config", options, workers: int = None):
+    """Merge media/proceeding files for multiple sessions, in parallel.
+
+    The number of workers can be set with OPTV_MERGE_WORKERS.
+
+    Yield (session, produced file Path) tuples as soon as each merge
+    is done. If the merge of a session fails, the error is logged and
+    the produced file is None.
+    """
+    if workers is None:
+        workers = worker_count('OPTV_MERGE_WORKERS')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict( (executor.submit(merge_session, session, config, options), session)
+                        for session in sessions )
+        for future in as_completed(futures):
+            session = futures[future]
+            try:
+                merged_file = future.result()
+            except Exception:
+                logger.exception(f"Cannot merge session {session}")
+                merged_file = None
+            yield session, merged_file
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Merge proceedings and media files.")
     parser.add_argument("proceedings_file", type=str, nargs='?',
@@ -320,6 +445,12 @@ if __name__ == "__main__":
                         help="Display debug messages")
     parser.add_argument("--output", metavar="DIRECTORY", type=str,
                         help="Output directory - if not specified, output with be to stdout")
+    parser.add_argument("--force", action="store_true",
+                        default=False,
+                        help="Merge files even if the output file is up-to-date")
+    parser.add_argument("--stream", action="store_true",
+                        default=False,
+                        help="Parse input files as streams (lower memory usage for large files)")
 
     args = parser.parse_args()
     if args.media_file is None or args.proceedings_file is None:
@@ -333,11 +464,22 @@ if __name__ == "__main__":
     p = Path(args.proceedings_file)
     m = Path(args.media_file)
 
+    if args.output and not args.force:
+        # Media files are named after the session - skip the merge
+        # altogether if the merged file is already up-to-date.
+        session = re.match(r'^(\d+)-media\.json$', m.name)
+        if session:
+            d = Path(args.output) / f"{session.group(1)}-merged.json"
+            if (d.exists()
+                and d.stat().st_mtime >= m.stat().st_mtime
+                and (not p.exists() or d.stat().st_mtime >= p.stat().st_mtime)):
+                logger.info(f"{d.name} is up-to-date - not merging")
+                sys.exit(0)
+
     output = merge_files(p, m, args)
     if args.output:
         d = Path(args.output) / f"{output['meta']['session']}-merged.json"
-        out = open(d, 'w')
+        save_json(output, d)
     else:
-        out = sys.stdout
-    json.dump(output, out, indent=2, ensure_ascii=False)
+        json.dump(output, sys.stdout, indent=2, ensure_ascii=False)
 
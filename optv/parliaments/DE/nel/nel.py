@@ -10,12 +10,14 @@ import logging
 logger = logging.getLogger(__name__)
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import json
+from functools import lru_cache
+import os
 from pathlib import Path
+import pickle
 import re
 import sys
-import unicodedata
 
 # Allow relative imports if invoked as a script
 # From https://stackoverflow.com/a/65780624/2870028
@@ -24,78 +26,153 @@ if __package__ is None:
     sys.path.insert(0, str(module_dir.parent))
     __package__ = module_dir.name
 
-def remove_accents(input_str):
-    nfkd_form = unicodedata.normalize('NFKD', input_str)
-    return u"".join([c for c in nfkd_form if not unicodedata.combining(c)])
+try:
+    from ..common import load_json, save_json, worker_count, remove_accents
+except ImportError:
+    # Invoked as a script - the parent directory is in sys.path
+    from common import load_json, save_json, worker_count, remove_accents
+
+NON_ALPHANUMERIC_RE = re.compile('[^A-Za-z0-9]+')
+# Labels which are already in cleaned-up form
+CLEAN_LABEL_RE = re.compile('[a-z0-9]+(?: [a-z0-9]+)*')
+
+@lru_cache(maxsize=4096)
+def cleanup_label(name: str) -> str:
+    if CLEAN_LABEL_RE.fullmatch(name):
+        # Nothing to clean up
+        return name
+    name = remove_accents(name.strip()).lower()
+    # Replace non-alphanumeric chars (including whitespaces) with
+    # space. Runs are replaced as a whole, so there cannot be
+    # multiple whitespaces left.
+    return NON_ALPHANUMERIC_RE.sub(' ', name)
 
 def cleanup(name):
     if not name or isinstance(name, dict):
         return None
     else:
-        name = remove_accents(name.strip()).lower()
-        # Replace non-alphanumeric chars with space
-        name = re.sub('[^A-Za-z0-9]+', ' ', name)
-        # Replace multiple whitespaces
-        name = re.sub(r'\s+', ' ', name)
-        return name
+        # The same labels occur many times, so cleaned values are cached
+        return cleanup_label(name)
 
 def link_entities(source: list, persons: dict, factions: dict) -> list:
     """Link entities from source file
     """
+    # Faction wid for each (raw) faction label. There are only a few
+    # distinct factions, so they are looked up only once.
+    faction_wids = {}
+    def faction_wid(label):
+        if not isinstance(label, str):
+            # Not a proper label (cleanup will reject it)
+            return factions.get(cleanup(label), { 'id': '' })['id']
+        wid = faction_wids.get(label)
+        if wid is None:
+            # Set a default value wid = '' for elements with non-aligned labels
+            wid = faction_wids[label] = factions.get(cleanup(label), { 'id': '' })['id']
+        return wid
+
     for speech in source:
         for p in speech.get('people', []):
-            label = cleanup(p['label'])
-            if persons.get(label):
+            # Only look up labels if there is some person data
+            person = persons.get(cleanup(p['label'])) if persons else None
+            if person:
                 # Found exact match
-                p['wid'] = persons[label]['id']
+                p['wid'] = person['id']
                 p['wtype'] = 'PERSON'
             faction = p.get('faction')
             if faction is not None:
                 if not isinstance(faction, dict):
-                    # Set a default value wid = '' for elements with non-aligned labels
-                    f = factions.get(cleanup(faction), { 'id': '' })
                     p['faction'] = {
-                        'wid': f['id'],
+                        'wid': faction_wid(faction),
                         'label': faction,
                         'wtype': 'ORG'
                     }
                 # Maybe already a dict. Update the wid in any case (maybe the entity dump changed)
                 else:
-                    f = factions.get(cleanup(faction['label']), { 'id': '' })
-                    faction['wid'] = f['id']
+                    faction['wid'] = faction_wid(faction['label'])
     return source
 
-def get_nel_data(nel_data_dir: Path = None):
-    nel_data_file = nel_data_dir / "entities.json"
-
+def build_nel_index(nel_data_file: Path) -> tuple:
+    """Build the (persons, factions) lookup dicts from the entities file
+    """
     persons = {}
     factions = {}
+    nel_data = load_json(nel_data_file)
+    # Convert to a dict for basic lookup
+    for ent in nel_data['data']:
+        if ent['subType'] == 'memberOfParliament':
+            store = persons
+        elif ent['subType'] == 'faction':
+            store = factions
+        else:
+            # Ignore other subTypes (party)
+            continue
+        store[cleanup(ent['label'])] = ent
+        for alt in ent['labelAlternative']:
+            store[cleanup(alt)] = ent
+    return persons, factions
+
+# Format version of the cached NEL index. Bump it whenever
+# build_nel_index or cleanup are modified, so that stale keys are not
+# used anymore.
+NEL_INDEX_VERSION = 1
+
+def load_nel_index(nel_data_file: Path, cache_dir: Path = None) -> tuple:
+    """Return the (persons, factions) lookup dicts for the entities file
+
+    If cache_dir is specified, the lookup dicts are cached in a pickle
+    file there, which is used as long as the entities file is not
+    modified and the index format version is unchanged.
+    """
+    if cache_dir is None:
+        return build_nel_index(nel_data_file)
+
+    index_file = Path(cache_dir) / "entities.idx.pkl"
+    source = str(nel_data_file.resolve())
+    try:
+        if index_file.stat().st_mtime >= nel_data_file.stat().st_mtime:
+            with open(index_file, 'rb') as f:
+                cached = pickle.load(f)
+            if (isinstance(cached, dict)
+                and cached.get('version') == NEL_INDEX_VERSION
+                and cached.get('source') == source):
+                return cached['persons'], cached['factions']
+            logger.info(f"Outdated NEL index cache {index_file} - rebuilding it")
+    except FileNotFoundError:
+        pass
+    except (pickle.UnpicklingError, EOFError, ValueError) as e:
+        logger.warning(f"Cannot read NEL index cache {index_file}: {e}")
+
+    persons, factions = build_nel_index(nel_data_file)
+    try:
+        index_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = Path(f"{index_file}.tmp")
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({ 'version': NEL_INDEX_VERSION,
+                          'source': source,
+                          'persons': persons,
+                          'factions': factions },
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, index_file)
+    except OSError as e:
+        # Not a problem - we will simply rebuild the index next time
+        logger.warning(f"Cannot cache NEL index into {index_file}: {e}")
+    return persons, factions
+
+def get_nel_data(nel_data_dir: Path = None, cache_dir: Path = None):
+    nel_data_file = nel_data_dir / "entities.json"
 
     if nel_data_file and nel_data_file.is_file():
-        with open(nel_data_file) as f:
-            nel_data = json.load(f)
-        # Convert to a dict for basic lookup
-        for ent in nel_data['data']:
-            if ent['subType'] == 'memberOfParliament':
-                store = persons
-            elif ent['subType'] == 'faction':
-                store = factions
-            else:
-                # Ignore other subTypes (party)
-                continue
-            store[cleanup(ent['label'])] = ent
-            for alt in ent['labelAlternative']:
-                store[cleanup(alt)] = ent
+        persons, factions = load_nel_index(nel_data_file, cache_dir)
     else:
         logger.error(f"Cannot read entities from {nel_data_file}")
+        persons, factions = {}, {}
     return persons, factions
 
 def link_entities_from_file(source_file: Path,
                             output_file: Path,
                             persons: dict,
                             factions: dict):
-    with open(source_file) as f:
-        source = json.load(f)
+    source = load_json(source_file)
 
     data = link_entities(source['data'], persons, factions)
 
@@ -107,14 +184,39 @@ def link_entities_from_file(source_file: Path,
                          },
                "data": data }
     logger.info(f"Writing {output_file.name}")
-    with open(output_file, 'w') as f:
-        json.dump(output, f, indent=2, ensure_ascii=False)
+    save_json(output, output_file)
+
+# NEL data (persons, factions) in worker processes
+_worker_nel_data = None
+
+def _init_worker(persons: dict, factions: dict):
+    global _worker_nel_data
+    _worker_nel_data = (persons, factions)
+
+def _link_entities_in_place(source: Path):
+    link_entities_from_file(source, source, *_worker_nel_data)
 
 def link_entities_from_directory(source_dir: Path,
                                  persons: dict,
-                                 factions: dict):
-    for source in sorted(source_dir.glob('*.json')):
-        link_entities_from_file(source, source, persons, factions)
+                                 factions: dict,
+                                 workers: int = None):
+    """Link entities in all files from source_dir, in parallel.
+
+    The number of workers can be set with OPTV_NEL_WORKERS.
+    """
+    if workers is None:
+        workers = worker_count('OPTV_NEL_WORKERS')
+    with os.scandir(source_dir) as entries:
+        sources = sorted(Path(entry.path)
+                         for entry in entries
+                         if entry.name.endswith('.json') and entry.is_file())
+    # NEL data is passed once to each worker, instead of with each file
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(persons, factions)) as executor:
+        # Consume the results, so that exceptions are propagated
+        for _ in executor.map(_link_entities_in_place, sources):
+            pass
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Link Named Entities from session file.")
@@ -125,6 +227,9 @@ if __name__ == '__main__':
     parser.add_argument("--nel-data-dir", action="store",
                         default=None,
                         help="Path to NEL data dir")
+    parser.add_argument("--cache-dir", action="store",
+                        default=None,
+                        help="Cache directory for the entities index (default: no cache)")
     parser.add_argument("--debug", dest="debug", action="store_true",
                         default=False,
                         help="Display debug messages")
@@ -142,7 +247,7 @@ if __name__ == '__main__':
         logger.error("No data dir for entities -- specify --nel-data-dir option.")
         sys.exit(1)
 
-    persons, factions = get_nel_data(Path(args.nel_data_dir))
+    persons, factions = get_nel_data(Path(args.nel_data_dir), args.cache_dir)
 
     source = Path(args.source)
     output = Path(args.output)
@@ -7,7 +7,7 @@ logger = logging.getLogger(__name__)
 
 import argparse
 from datetime import datetime
-import json
+from functools import lru_cache
 from pathlib import Path
 import requests.exceptions
 import spacy
@@ -21,41 +21,82 @@ if __package__ is None:
     sys.path.insert(0, str(module_dir.parent))
     __package__ = module_dir.name
 
+try:
+    from ..common import load_json, save_json, stream_json
+except ImportError:
+    # Invoked as a script - the parent directory is in sys.path
+    from common import load_json, save_json, stream_json
+
+# Default number of sentences passed at once through the spaCy pipeline
+DEFAULT_BATCH_SIZE = 128
+
+@lru_cache(maxsize=4)
+def get_nlp(lang: str, api_endpoint: str, gpu: bool = False):
+    """Return the spaCy pipeline for the given language and entityfishing server.
+
+    The model is loaded once, and reused for all processed files.
+    If gpu is True, it is run on the GPU (which must be available).
+    Return None if the entityfishing factory is not available.
+    """
+    if gpu:
+        # Must be called before loading the model
+        spacy.require_gpu()
+    # nlp = spacy.blank(lang)
+    nlp = spacy.load(f"{lang}_core_news_md")
+    if 'entityfishing' not in nlp.factory_names:
+        return None
+    nlp.add_pipe("entityfishing", config={ 'language': lang,
+                                           'api_ef_base': api_endpoint })
+    return nlp
+
+def doc_entities(doc) -> list:
+    """Return the linked entities from a processed spaCy doc
+    """
+    return [ dict(label=ent.text,
+                  wid=ent._.kb_qid,
+                  wtype=ent.label_,
+                  score=ent._.nerd_score)
+             for ent in doc.ents
+             if ent._.kb_qid
+            ]
 
 def extract_entities(source: list, args) -> list:
     """Extract entities from source file
 
     It uses the args.lang parameter to specify the language
     """
-    # nlp = spacy.blank(args.lang)
     if not args.ner_api_endpoint:
         return source
-    nlp = spacy.load(f"{args.lang}_core_news_md")
-    if 'entityfishing' in nlp.factory_names:
-        nlp.add_pipe("entityfishing", config={ 'language': args.lang,
-                                               'api_ef_base': args.ner_api_endpoint })
-    else:
+    nlp = get_nlp(args.lang, args.ner_api_endpoint, getattr(args, 'gpu', False))
+    if nlp is None:
         logger.error("Cannot find entityfishing spaCy factory. Cannot do NER.")
         return
 
+    batch_size = getattr(args, 'ner_batch_size', None) or DEFAULT_BATCH_SIZE
     for item in source:
         start_time = time.time()
-        for content in item.get('textContents', []):
-            for speech in content.get('textBody', []):
-                for sentence in speech.get('sentences', []):
-                    try:
-                        doc = nlp(sentence.get('text', ""))
-                        entities = [ dict(label=ent.text,
-                                          wid=ent._.kb_qid,
-                                          wtype=ent.label_,
-                                          score=ent._.nerd_score)
-                                     for ent in doc.ents
-                                     if ent._.kb_qid
-                                    ]
-                        sentence['entities'] = entities
-                    except requests.exceptions.HTTPError as e:
-                        # The entity-fishing server may respond with a 503 server error
-                        logger.error(f"NER Server error: {e}")
+        sentences = [ sentence
+                      for content in item.get('textContents', [])
+                      for speech in content.get('textBody', [])
+                      for sentence in speech.get('sentences', []) ]
+        # Process the sentences of the speech in batches
+        done = 0
+        try:
+            for sentence, doc in zip(sentences,
+                                     nlp.pipe((sentence.get('text', "") for sentence in sentences),
+                                              batch_size=batch_size)):
+                sentence['entities'] = doc_entities(doc)
+                done += 1
+        except requests.exceptions.HTTPError as e:
+            # The entity-fishing server may respond with a 503 server error
+            logger.error(f"NER Server error: {e}")
+            # Process the remaining sentences one by one, so that
+            # only the failing ones are skipped.
+            for sentence in sentences[done:]:
+                try:
+                    sentence['entities'] = doc_entities(nlp(sentence.get('text', "")))
+                except requests.exceptions.HTTPError as e:
+                    logger.error(f"NER Server error: {e}")
         end_time  = time.time()
         debug = item.setdefault('debug', {})
         debug['ner-duration'] = end_time - start_time
@@ -63,8 +104,9 @@ def extract_entities(source: list, args) -> list:
     return source
 
 def extract_entities_from_file(source_file, output_file, args):
-    with open(source_file) as f:
-        source = json.load(f)
+    # Large files can be parsed as a stream, to limit memory usage
+    load = stream_json if getattr(args, 'stream', False) else load_json
+    source = load(source_file)
 
     data = extract_entities(source['data'], args)
 
@@ -76,8 +118,7 @@ def extract_entities_from_file(source_file, output_file, args):
                     },
                "data": data
               }
-    with open(output_file, 'w') as f:
-        json.dump(output, f, indent=2, ensure_ascii=False)
+    save_json(output, output_file)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Extract entities from proceedings text in OPTV json.")
@@ -89,6 +130,14 @@ if __name__ == '__main__':
                         help="Language")
     parser.add_argument("--ner-api-endpoint", type=str, default="",
                         help="API endpoint URL for entityfishing server")
+    parser.add_argument("--ner-batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"Number of sentences processed at once (default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--stream", action="store_true",
+                        default=False,
+                        help="Parse the input file as a stream (lower memory usage for large files)")
+    parser.add_argument("--gpu", action="store_true",
+                        default=False,
+                        help="Run the spaCy pipeline on GPU (requires CUDA)")
     parser.add_argument("--debug", dest="debug", action="store_true",
                         default=False,
                         help="Display debug messages")
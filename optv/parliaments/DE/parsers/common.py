@@ -13,6 +13,12 @@ STATUS_TRANSLATION = {
     'Alterspräsidentin': 'interim-president',
 }
 
+# Precompiled regexps for labels cleanup
+LEADING_NON_ALPHA_RE = re.compile(r'^[^\w]+')
+TRAILING_NON_ALPHA_RE = re.compile(r'[^\w]+$')
+NBSP_RE = re.compile(r'\xc2\xa0')
+WHITESPACE_RE = re.compile(r'\s+')
+
 def parse_fullname(label: str) -> tuple:
     """Return a tuple (name, status)
 
@@ -22,17 +28,17 @@ def parse_fullname(label: str) -> tuple:
         return None
 
     # Strip leading/trailing non-alphabetic chars
-    label = re.sub('^[^\w]+', '', label)
-    label = re.sub('[^\w]+$', '', label)
+    label = LEADING_NON_ALPHA_RE.sub('', label)
+    label = TRAILING_NON_ALPHA_RE.sub('', label)
     # Replace non-breaking whitespaces
-    label = re.sub(r'\xc2\xa0', ' ', label)
+    label = NBSP_RE.sub(' ', label)
     # Replace multiple whitespaces
-    label = re.sub(r'\s+', ' ', label)
+    label = WHITESPACE_RE.sub(' ', label)
     # Fix strange notation, like in 19040, 19170, 19176...
     label = label.replace('räsident in', 'räsidentin')
 
     # Split at the first whitespace to get possible status information
-    info = re.split('\s+', label, 1)
+    info = WHITESPACE_RE.split(label, 1)
     if len(info) == 2 and info[0] in STATUS_TRANSLATION:
         return (fix_fullname(info[1]), STATUS_TRANSLATION.get(info[0]))
 
@@ -43,9 +49,9 @@ def fix_fullname(label: str) -> str:
     if label is None:
         return label
     # Replace non-breaking whitespaces
-    label = re.sub(r'\xc2\xa0', ' ', label)
+    label = NBSP_RE.sub(' ', label)
     # Replace multiple whitespaces
-    label = re.sub(r'\s+', ' ', label)
+    label = WHITESPACE_RE.sub(' ', label)
     label = label.replace('Dr. ', '').replace('h. c. ', '').replace('Prof. ', '').replace('Graf Graf ', 'Graf ')
     # There are 3 cases:
     # 19060: Carsten Sieling, Bürgermeister
@@ -60,7 +66,7 @@ def fix_faction(label: str) -> str:
     if label is None:
         return label
     # Replace non-breaking whitespaces (\xa0) and multiple whitespaces
-    label = re.sub(r'\s+', ' ', label)
+    label = WHITESPACE_RE.sub(' ', label)
     return label.replace('B90/Grüne', 'BÜNDNIS 90/DIE GRÜNEN')
 
 def fix_role(role: str) -> str:
@@ -7,8 +7,10 @@ import logging
 logger = logging.getLogger(__name__)
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 import feedparser
+from functools import lru_cache
 import json
 import os
 from pathlib import Path
@@ -25,6 +27,8 @@ except ModuleNotFoundError:
     base_dir = Path(__file__).resolve().parent.parent
     sys.path.insert(0, str(base_dir))
     from parsers.common import fix_faction, fix_fullname, fix_role
+# We know here that we can do package imports
+from common import load_json, save_json, worker_count
 
 # Constants used for basic integrity checking: If these values are not
 # present in the source data, then something must have changed and the
@@ -34,6 +38,11 @@ FEED_LICENSE = '&lt;a href=&quot;https://www.bundestag.de/nutzungsbedingungen&qu
 FEED_AUTHOR_EMAIL = 'mail@bundestag.de'
 # Note that <faction> may be empty (in the case of Nationalhymne)
 title_data_re = re.compile(r'Redebeitrag\s+von\s+(?P<fullname>.+?)\s+\((?P<faction>.*?)\),?\s+am (?P<title_date>[\d.]+)\s+um\s+(?P<title_time>[\d:]+)\s+Uhr\s+\((?P<session_info>.+)\)')
+# Regexps used for title/date fixing
+zusatz_re = re.compile(r'TOP(?:\s+\d+)?,?\s+(ZP|Epl)\s*(\d+)', flags=re.IGNORECASE)
+top_re = re.compile(r'^TOP\s+(.+)')
+utc_offset_re = re.compile(r'^([+-])(\d\d)(\d\d)$')
+sitzung_prefix_re = re.compile(r'^\d+\.\sSitzung,\s')
 
 def extract_title_data(title: str) -> Optional[dict]:
     """Extract structured data from title string.
@@ -47,18 +56,21 @@ def extract_title_data(title: str) -> Optional[dict]:
     else:
         return None
 
+@lru_cache(maxsize=1024)
 def fix_title(title: str) -> str:
     """Fix the titles to match with proceedings conventions
+
+    The same titles occur for many entries, so results are cached.
     """
     title = title.replace("TOP Sitzungsende", "Sitzungsende").replace("TOP Sitzungseröffnung", "Sitzungseröffnung")
 
-    zusatz = re.findall(r'TOP(?:\s+\d+)?,?\s+(ZP|Epl)\s*(\d+)', title, flags=re.IGNORECASE)
+    zusatz = zusatz_re.findall(title)
     if zusatz:
         if zusatz[0][0].lower() == 'zp':
             title = f"Zusatzpunkt {zusatz[0][1]}"
         else:
             title = f"Einzelplan {zusatz[0][1]}"
-    title = re.sub(r'^TOP\s+(.+)', 'Tagesordnungspunkt \\1', title)
+    title = top_re.sub('Tagesordnungspunkt \\1', title)
     title = title.rstrip(".")
     return title
 
@@ -126,17 +138,21 @@ def parse_media_data(data: dict, fixups: dict = None) -> dict:
 
     for e in entries:
         e = apply_media_fixups(e, meeting_reference, fixups)
-        links = dict( (link['rel'], link) for link in e['links'] )
-
-        if 'enclosure' not in links:
+        # We only need the enclosure link. Look for it from the end,
+        # so that the last one wins, as when building a dict indexed
+        # by 'rel'.
+        enclosure = next((link for link in reversed(e['links']) if link['rel'] == 'enclosure'), None)
+        if enclosure is None:
             # No media associated to the item.
             # FIXME: should we report the issue?
             logger.debug(f"No media associated: {e['title']}")
             continue
 
         # Use duration to compute end time
-        t = datetime.strptime(e['itunes_duration'],"%H:%M:%S")
-        delta = timedelta(hours=t.hour, minutes=t.minute, seconds=t.second)
+        # It is in HH:MM:SS format - simply split it, which is much
+        # faster than strptime
+        hours, minutes, seconds = e['itunes_duration'].split(':')
+        delta = timedelta(hours=int(hours), minutes=int(minutes), seconds=int(seconds))
 
         # FIXME: el['published_parsed'] in in UTC.  But TZ info is
         # present in el['published'] and the proceedings official
@@ -148,13 +164,14 @@ def parse_media_data(data: dict, fixups: dict = None) -> dict:
         # Timezone info is not preserved by feedparser, re-add it:
         # Get UTC offset from el['published']
         utc_offset = e['published'].strip()[-5:]
-        m = re.match(r'^([+-])(\d\d)(\d\d)$', utc_offset)
+        m = utc_offset_re.match(utc_offset)
         if m:
             sign, hours, minutes = m.groups()
             # Found a valid UTC offset - we should make the startdate
             # aware
-            utc_delta = timedelta(hours=int(f"{sign}{hours}"),
-                                  minutes=int(f"{sign}{minutes}"))
+            sign = -1 if sign == '-' else 1
+            utc_delta = timedelta(hours=sign * int(hours),
+                                  minutes=sign * int(minutes))
             tz = timezone(utc_delta)
             # We add the utc_delta to naive startdate, so that it
             # corresponds to the tzinfo we replace after.
@@ -183,7 +200,7 @@ def parse_media_data(data: dict, fixups: dict = None) -> dict:
                 'originalTitle': e['title']
             },
             "media": {
-                'videoFileURI': links['enclosure']['href'],
+                'videoFileURI': enclosure['href'],
                 'sourcePage': e['link'],
                 'duration': delta.total_seconds(),
                 'creator': e['author'],
@@ -234,7 +251,7 @@ def parse_media_data(data: dict, fixups: dict = None) -> dict:
             if metadata.get('session_info') is not None:
                 # According to https://github.com/OpenParliamentTV/OpenParliamentTV-Parsers/issues/1
                 # we should strip the Sitzung prefix from the session_info
-                item['agendaItem']['officialTitle'] = fix_title(re.sub(r'^\d+\.\sSitzung,\s', '', metadata.get('session_info')))
+                item['agendaItem']['officialTitle'] = fix_title(sitzung_prefix_re.sub('', metadata.get('session_info')))
             # FIXME: we have other fields: title_date, title_time that we could use for validation
 
         # Fix AgendaItemTitle if necessary
@@ -277,25 +294,57 @@ def parse_file(filename: str, fixups: dict) -> list[dict]:
     if filename.suffix == '.xml':
         return parse_rss(filename, fixups)
     elif filename.suffix == '.json':
-        with open(filename) as f:
-            raw_data = json.load(f)
+        raw_data = load_json(filename)
         return parse_media_data(raw_data, fixups)
     else:
         logger.error(f"Unable to determine file type for {filename}")
         return []
 
-def parse_media_directory(directory: Path):
+def parse_media_file(source: Path, output_file: Path) -> Path:
+    """Parse the raw media source file into output_file
+    """
+    source_data = load_json(source)
+    data = parse_media_data(source_data)
+    logger.info(f"Converting {source.name}")
+    return save_json(data, output_file)
+
+def parse_media_directory(directory: Path, workers: int = None):
     """Update parsed versions of media files.
+
+    Files are parsed in parallel. The number of workers can be set
+    with OPTV_PARSE_WORKERS.
     """
-    for source in sorted(directory.glob('raw-*.json')):
-        output_file = source.parent / source.name[4:]
+    directory = Path(directory)
+    if not directory.is_dir():
+        return
+    # Use scandir, which does not build a Path for each directory entry
+    with os.scandir(directory) as entries:
+        sources = sorted((entry.name, entry.stat().st_mtime)
+                         for entry in entries
+                         if entry.name.startswith('raw-') and entry.name.endswith('.json'))
+    to_parse = []
+    for name, source_mtime in sources:
+        source = directory / name
+        output_file = directory / name[4:]
+        try:
+            output_mtime = output_file.stat().st_mtime
+        except FileNotFoundError:
+            output_mtime = None
         # If the output file does not exist, or is older than source file:
-        if not output_file.exists() or output_file.stat().st_mtime < source.stat().st_mtime:
-            source_data = json.loads(source.read_text())
-            data = parse_media_data(source_data)
-            logger.info(f"Converting {source.name}")
-            with open(output_file, 'w') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+        if output_mtime is None or output_mtime < source_mtime:
+            to_parse.append((source, output_file))
+
+    if workers is None:
+        workers = worker_count('OPTV_PARSE_WORKERS')
+    if workers == 1 or len(to_parse) <= 1:
+        # No need for a pool (and easier to debug)
+        for source, output_file in to_parse:
+            parse_media_file(source, output_file)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Consume the results, so that exceptions are propagated
+            for _ in executor.map(parse_media_file, *zip(*to_parse)):
+                pass
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Parse Bundestag Media XML files or raw JSON files.")
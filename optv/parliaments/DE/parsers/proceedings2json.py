@@ -11,9 +11,9 @@ logger = logging.getLogger(__name__)
 
 import argparse
 from datetime import datetime
-from itertools import takewhile
 import json
 from lxml import etree
+import os
 from pathlib import Path
 import re
 from spacy.lang.de import German
@@ -27,6 +27,11 @@ if __package__ is None:
     __package__ = module_dir.name
 
 from .common import fix_faction, fix_fullname, parse_fullname
+try:
+    from ..common import save_json
+except ImportError:
+    # Invoked as a script - the parent directory is in sys.path
+    from common import save_json
 
 PROCEEDINGS_LICENSE = "Public Domain"
 PROCEEDINGS_LANGUAGE = "DE-de"
@@ -208,9 +213,11 @@ def parse_ordnungpunkt(op, last_speaker: dict, last_redeid: str, session_id: str
 
     # Consider only p or rede elements
     elements = [ node for node in op if node.tag in ('p', 'name', 'rede') ]
+    # Positions of <rede> elements, used to slice leading/trailing <p>
+    rede_positions = [ i for i, e in enumerate(elements) if e.tag == 'rede' ]
 
     # Get rede id from first rede node
-    first_rede = next( (e for e in elements if e.tag == 'rede'), None)
+    first_rede = elements[rede_positions[0]] if rede_positions else None
     if first_rede is not None:
         rede_id = first_rede.attrib.get('id', '')
     else:
@@ -223,7 +230,7 @@ def parse_ordnungpunkt(op, last_speaker: dict, last_redeid: str, session_id: str
             rede_id = f"{last_redeid}{VIRTUAL_SPEECH}"
 
     # Produce a virtual introduction
-    introduction = list(takewhile(lambda n: n.tag in ('p', 'name'), elements))
+    introduction = elements[:rede_positions[0]] if rede_positions else elements
     if introduction:
         turns = list(parse_speech(introduction, last_speaker, f"{rede_id}{LEADING_SPEECH}"))
         if turns:
@@ -246,7 +253,7 @@ def parse_ordnungpunkt(op, last_speaker: dict, last_redeid: str, session_id: str
     # We do not want to process then again.
     if first_rede is not None:
         # Trailing <p> elements after last <rede>
-        closing = list(reversed(list(takewhile(lambda n: n.tag in ('p', 'name'), reversed(elements)))))
+        closing = elements[rede_positions[-1] + 1:]
         if closing:
             turns = list(parse_speech(closing, last_speaker, f"{rede_id}{TRAILING_SPEECH}"))
             if turns:
@@ -519,17 +526,25 @@ def parse_proceedings(source: str, output: str, uri: str, args):
     elif output:
         output_file = get_parsed_proceedings_filename(source, output)
         logger.debug(f"Saving to {output_file}")
-        with open(output_file, 'w') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        save_json(data, output_file)
     return data
 
 def parse_proceedings_directory(directory: Path, args):
     """Update parsed versions of proceedings files.
     """
-    for source in sorted(directory.glob('*.xml')):
-        output_file = get_parsed_proceedings_filename(source, directory)
+    directory = Path(directory)
+    if not directory.is_dir():
+        return
+    # Get the source (.xml) and output files from a single directory
+    # scan. Their modification times are cached by the DirEntry objects.
+    with os.scandir(directory) as it:
+        entries = dict((entry.name, entry) for entry in it)
+    for name in sorted(n for n in entries if n.endswith('.xml')):
+        source = directory / name
+        output_entry = entries.get(get_parsed_proceedings_filename(source, directory).name)
         # If the output file does not exist, or is older than source file:
-        if not output_file.exists() or output_file.stat().st_mtime < source.stat().st_mtime:
+        if (output_entry is None
+            or output_entry.stat().st_mtime < entries[name].stat().st_mtime):
             # Since we do not know the source URI, we specify the local filename
             parse_proceedings(source, directory, str(source), args)
 
@@ -27,7 +27,7 @@ except ModuleNotFoundError:
     sys.path.insert(0, str(base_dir))
     from parsers.media2json import parse_media_data
 # We know here that we can do package imports
-from common import save_if_changed
+from common import load_json, save_if_changed
 
 ROOT_URL = "https://webtv.bundestag.de/player/macros/bttv/podcast/video/plenar.xml"
 SERVER_ROOT = "https://www.bundestag.de"
@@ -127,8 +127,7 @@ def download_data(period, meeting=None, output=None, save_raw_data=False, force=
             # There is a raw data dump. Use it rather than downloading
             # it again.
             logger.warning(f"Using data dump {raw_filename}")
-            with open(output_dir / raw_filename) as f:
-                raw_data = json.load(f)
+            raw_data = load_json(output_dir / raw_filename)
         else:
             raw_data = download_meeting_data(period, meeting)
         if not raw_data['entries']:
@@ -14,11 +14,14 @@ import lxml.html
 import os
 from pathlib import Path
 import re
+import shutil
 import sys
 import urllib.request
 import urllib3
 
 SERVER_ROOT = "https://www.bundestag.de"
+# Buffer size used when writing downloaded files
+COPY_BUFFER_SIZE = 1024 * 1024
 
 AJAX_ID = {
     # Ajax ID Period 19
@@ -86,8 +89,9 @@ def download_plenary_protocols(destination_dir: str, fullscan: bool = False, per
                         else:
                             out.write(pi)
                             out.write(first_line)
-                        # Write the rest of the file
-                        out.write(f.read())
+                        # Write the rest of the file, streaming it
+                        # instead of reading it entirely in memory
+                        shutil.copyfileobj(f, out, COPY_BUFFER_SIZE)
                 created_files.append( (filename, file_url) )
         if link_count == 0:
             # Empty file, end of data
@@ -6,7 +6,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 import argparse
-import json
+import os
 from pathlib import Path
 from random import random
 import re
@@ -20,7 +20,7 @@ if __package__ is None:
     sys.path.insert(0, str(module_dir.parent))
     __package__ = module_dir.name
 
-from .fetch_media import download_meeting_data, download_data, get_filename, parse_media_data, save_if_changed
+from .fetch_media import download_meeting_data, download_data, get_filename, load_json, parse_media_data, save_if_changed
 
 # Max time to wait between retries (in seconds)
 RETRY_MAX_WAIT_TIME = 10
@@ -29,13 +29,23 @@ def update_media_from_raw(media_dir):
     """Update media files that are older than raw media data, or non-existent
     """
     media_dir = Path(media_dir)
-    for raw in sorted(media_dir.glob("raw-*.json")):
-        parsed = media_dir / raw.name[4:]
-        if (not parsed.exists() or
-            raw.stat().st_mtime > parsed.stat().st_mtime):
+    if not media_dir.is_dir():
+        return
+    # Use scandir, which does not build a Path for each directory entry
+    with os.scandir(media_dir) as entries:
+        raw_files = sorted((entry.name, entry.stat().st_mtime)
+                           for entry in entries
+                           if entry.name.startswith('raw-') and entry.name.endswith('.json'))
+    for name, raw_mtime in raw_files:
+        raw = media_dir / name
+        parsed = media_dir / name[4:]
+        try:
+            parsed_mtime = parsed.stat().st_mtime
+        except FileNotFoundError:
+            parsed_mtime = None
+        if parsed_mtime is None or raw_mtime > parsed_mtime:
             # Need an update
-            with open(raw) as f:
-                raw_data = json.load(f)
+            raw_data = load_json(raw)
             data = parse_media_data(raw_data)
             save_if_changed(data, parsed)
 
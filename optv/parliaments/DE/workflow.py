@@ -3,7 +3,6 @@
 # Update media files, proceeding files and merge them
 import argparse
 import atexit
-import json
 import logging
 import os
 from pathlib import Path
@@ -18,16 +17,16 @@ if __package__ is None:
     sys.path.insert(0, str(module_dir.parent))
     __package__ = module_dir.name
 
-from .common import Config, SessionStatus, data_signature
+from .common import Config, SessionStatus, data_status, load_json, mtime_ns
 
 logger = logging.getLogger(__name__ if __name__ != '__main__' else os.path.basename(sys.argv[0]))
 
 from .aligner.align_sentences import align_audiofile
-from .ner.ner import extract_entities_from_file
+from .ner.ner import DEFAULT_BATCH_SIZE, extract_entities_from_file
 from .nel.nel import link_entities_from_file, get_nel_data
 from .scraper.update_media import update_media_directory_period, update_media_from_raw
 from .scraper.fetch_proceedings import download_plenary_protocols
-from .merger.merge_session import merge_session
+from .merger.merge_session import merge_many
 from .parsers.proceedings2json import parse_proceedings_directory
 
 def execute_workflow(args):
@@ -43,13 +42,18 @@ def execute_workflow(args):
         # It happens when process such as nel/align is run again
         published_data = { 'data': [] }
         if processed_file.exists():
-            published_data = json.loads(processed_file.read_text())
-        new_data = json.loads(filepath.read_text())
-        # Compare actual data, ignoring metadata (with processing info)
-        if data_signature(published_data['data']) != data_signature(new_data['data']):
+            published_data = load_json(processed_file)
+        new_data = load_json(filepath)
+        # Compare actual data, ignoring metadata (with processing
+        # info). The structures are compared directly, which stops at
+        # the first difference, instead of serializing both.
+        if published_data['data'] != new_data['data']:
             # Data is updated, copy new version
             logger.warning(f"Publishing {session} from {filepath.name}")
             shutil.copyfile(filepath, processed_file)
+            # Update cached status info, so that we do not have to
+            # parse the processed file again.
+            config.save_status(session, data_status(new_data['data']))
         return processed_file
 
     if args.download_original:
@@ -75,24 +79,36 @@ def execute_workflow(args):
     # Produce merged data
     if args.merge_speeches:
         logger.info(f"Merging data from {config.dir('media')} and {config.dir('proceedings')} into {config.dir('merged')}")
+        to_merge = []
         for session in config.sessions():
             if args.limit_to_period and not session.startswith(str(args.period)):
                 continue
             if args.limit_session and not re.match(args.limit_session, session):
                 continue
-            # Always redo the merge in case any source was updated
-            if config.is_newer(session, 'media', 'merged') or config.is_newer(session, 'proceedings', 'merged'):
-                merged_file = merge_session(session, config, args)
-                status = config.status(session)
-                # We want to directly publish this file if it did not exist
-                # or if there is no data (time, ner) to lose doing it
-                if (SessionStatus.aligned in status
-                    or SessionStatus.ner in status):
-                    continue
-                # If we reach here, it is either that the processed file
-                # was not present, or that it has no time/entity info, so
-                # that we will lose nothing.
-                publish_as_processed(session, merged_file)
+            # Always redo the merge in case any source was updated.
+            # Stat each file only once, since most sessions are unchanged.
+            media, proceedings, merged = (mtime_ns(config.file(session, stage))
+                                          for stage in ('media', 'proceedings', 'merged'))
+            if (merged is None
+                or (media is not None and media > merged)
+                or (proceedings is not None and proceedings > merged)):
+                to_merge.append(session)
+        # Sessions are merged in parallel, and published as soon as
+        # they are merged
+        for session, merged_file in merge_many(to_merge, config, args):
+            if merged_file is None:
+                # Merge failed (the error has been logged)
+                continue
+            status = config.status(session)
+            # We want to directly publish this file if it did not exist
+            # or if there is no data (time, ner) to lose doing it
+            if (SessionStatus.aligned in status
+                or SessionStatus.ner in status):
+                continue
+            # If we reach here, it is either that the processed file
+            # was not present, or that it has no time/entity info, so
+            # that we will lose nothing.
+            publish_as_processed(session, merged_file)
 
     # Do entity linking for people and factions in merged files
     if args.link_entities:
@@ -100,7 +116,7 @@ def execute_workflow(args):
         if nel_data_dir is None or not nel_data_dir.is_dir():
             logger.error(f"Cannot do NEL - {nel_data_dir} does not exist")
         else:
-            persons, factions = get_nel_data(nel_data_dir)
+            persons, factions = get_nel_data(nel_data_dir, config.dir('cache'))
             logger.info("Linking entities with wikidata IDs")
             for session in config.sessions():
                 if args.limit_to_period and not session.startswith(str(args.period)):
@@ -198,6 +214,8 @@ if __name__ == "__main__":
 
     parser.add_argument("--ner-api-endpoint", type=str, default="",
                         help="API endpoint URL for entityfishing server")
+    parser.add_argument("--ner-batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"Number of sentences processed at once for NER (default: {DEFAULT_BATCH_SIZE})")
 
     # Processing steps
     parser.add_argument("--download-original", action=argparse.BooleanOptionalAction,